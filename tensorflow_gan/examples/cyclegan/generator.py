@@ -13,109 +13,530 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Defines the CycleGAN generator and discriminator networks."""
+"""Defines the CycleGAN generator and discriminator networks.
+
+Convolutions that are directly followed by a bias add (see `use_output_bias`)
+can be rewritten by Grappler's remapper into a single `_FusedConv2D` op. The
+remapper is on by default, and can be controlled with
+`tf.config.optimizer.set_experimental_options({'remapping': True})`.
+"""
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import functools
+
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow.compat.v1 as tf
 import tensorflow_gan as tfgan
 
+# Shared by all convolutions, rather than building an initializer per variable.
+_KERNEL_INITIALIZER = tf.random_normal_initializer(0, 0.02)
+
+
+@contextlib.contextmanager
+def _xla_scope(use_xla):
+  """Marks the ops created in this context for XLA compilation if `use_xla`."""
+  # `jit_scope` is a graph construction utility and raises in eager mode.
+  if use_xla and not tf.executing_eagerly():
+    with tf.xla.experimental.jit_scope():
+      yield
+  else:
+    yield
+
+
+def _instance_norm(x, activation_fn=None, use_xla=False, data_format='NHWC'):
+  with _xla_scope(use_xla):
+    # The affine gamma and beta are applied as part of the per-channel scale and
+    # offset of the normalization, so they cost no extra pass over `x`. They
+    # can't be folded into the adjacent convolutions: the normalization undoes
+    # any per-channel scaling of the conv before it, and the ReLU or skip
+    # connection separates it from the conv after it.
+    # Compute the statistics and parameters in float32 for reduced precision
+    # activations.
+    dtype = x.dtype
+    x = tfgan.features.instance_norm(
+        tf.cast(x, tf.float32),
+        center=True,
+        scale=True,
+        epsilon=0.001,
+        activation_fn=activation_fn,
+        data_format=data_format)
+    return tf.cast(x, dtype)
+
+
+def _float32_variable_getter(getter, name, shape=None, dtype=None, *args,
+                             **kwargs):
+  """Stores reduced precision variables in float32 and casts them on read."""
+  storage_dtype = dtype
+  if dtype in (tf.float16, tf.bfloat16):
+    storage_dtype = tf.float32
+  variable = getter(name, shape, storage_dtype, *args, **kwargs)
+  if storage_dtype != dtype:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+
+@functools.lru_cache(maxsize=None)
+def _same_paddings(kernel_height, kernel_width, data_format='NHWC'):
+  """Returns the paddings to keep the spatial size of a 'VALID' convolution.
+
+  The arrays are cached, so repeated graph constructions reuse the same
+  read-only object instead of creating a new one for every pad.
+
+  Args:
+    kernel_height: The height of the convolution kernel.
+    kernel_width: The width of the convolution kernel.
+    data_format: The data format of the padded tensor, 'NHWC' or 'NCHW'.
+
+  Returns:
+    A read-only [4, 2] int32 array of `tf.pad` paddings.
+  """
+  height_paddings = [(kernel_height - 1) // 2, kernel_height // 2]
+  width_paddings = [(kernel_width - 1) // 2, kernel_width // 2]
+  if data_format == 'NCHW':
+    paddings = np.array([[0, 0], [0, 0], height_paddings, width_paddings],
+                        dtype=np.int32)
+  else:
+    paddings = np.array([[0, 0], height_paddings, width_paddings, [0, 0]],
+                        dtype=np.int32)
+  paddings.flags.writeable = False
+  return paddings
+
+
+def _resize(net, size, method, data_format='NHWC'):
+  """`tf.image.resize`, which only supports NHWC, for either data format."""
+  if data_format == 'NCHW':
+    net = tf.transpose(a=net, perm=[0, 2, 3, 1])
+  # Bilinear resizing always returns float32.
+  net = tf.cast(tf.image.resize(net, size, method=method), net.dtype)
+  if data_format == 'NCHW':
+    net = tf.transpose(a=net, perm=[0, 3, 1, 2])
+  return net
+
+
+def _nn_upsample(net, strides, data_format='NHWC'):
+  """Nearest neighbor upsampling by integer `strides`, as two `tf.repeat`s.
+
+  This gives the same result as `tf.image.resize` with `NEAREST_NEIGHBOR`, but
+  as a plain re-layout of memory that works in either data format and avoids
+  the slow nearest neighbor resize kernels of some runtimes.
+
+  Args:
+    net: A Tensor of size [batch_size, height, width, filters], or of size
+      [batch_size, filters, height, width] if `data_format` is 'NCHW'.
+    strides: A list of 2 Python ints, the upsampling factors.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
 
-def _instance_norm(x):
-  return tfgan.features.instance_norm(
-      x,
-      center=True,
-      scale=True,
-      epsilon=0.001)
+  Returns:
+    The upsampled Tensor.
+  """
+  height_axis, width_axis = (2, 3) if data_format == 'NCHW' else (1, 2)
+  net = tf.repeat(net, strides[0], axis=height_axis)
+  return tf.repeat(net, strides[1], axis=width_axis)
 
 
 def cyclegan_upsample(net,
                       num_outputs,
                       strides,
                       method='conv2d_transpose',
-                      pad_mode='REFLECT'):
+                      pad_mode='REFLECT',
+                      fused_pad_conv=False,
+                      use_xla=False,
+                      data_format='NHWC'):
   """Upsamples the given inputs.
 
   Args:
-    net: A Tensor of size [batch_size, height, width, filters].
+    net: A Tensor of size [batch_size, height, width, filters], or of size
+      [batch_size, filters, height, width] if `data_format` is 'NCHW'.
     num_outputs: The number of output filters.
     strides: A list of 2 scalars or a 1x2 Tensor indicating the scale,
       relative to the inputs, of the output dimensions. For example, if kernel
       size is [2, 3], then the output height and width will be twice and three
       times the input size.
     method: The upsampling method: 'nn_upsample_conv', 'bilinear_upsample_conv',
-      or 'conv2d_transpose'.
+      'subpixel' or 'conv2d_transpose'. 'subpixel' convolves to
+      `num_outputs * strides[0] * strides[1]` filters and rearranges them into
+      the upsampled output with `tf.nn.depth_to_space`. This costs as many
+      FLOPs as the resize-conv methods, and `strides[0] * strides[1]` times as
+      many as 'conv2d_transpose'. It requires equal strides, and supports the
+      'NCHW' `data_format` only on GPU.
     pad_mode: mode for tf.pad, one of "CONSTANT", "REFLECT", or "SYMMETRIC".
+    fused_pad_conv: If True, fold the padding of the 3x3 convolution of the
+      'nn_upsample_conv' and 'subpixel' methods into a single `FusedPadConv2D`
+      op, and both the resize and the padding of the 'bilinear_upsample_conv'
+      method into a single `FusedResizeAndPadConv2D` op. Only has an effect for
+      "REFLECT" and "SYMMETRIC" `pad_mode`s. The fused ops only have CPU
+      kernels and no gradients, so this is meant for inference. They are only
+      correct for the first example of a batch, so unless the static batch
+      size is 1, they run one example at a time in a `tf.map_fn`, which adds a
+      copy of the outputs. The fused path can only pay off at batch size 1.
+      The fused bilinear resize samples the same way as the unfused
+      `tf.compat.v1.image.resize`, so both give the same outputs.
+    use_xla: If True, compile the instance norm and ReLU into a single XLA
+      cluster, so that they make only one pass over the activations.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
 
   Returns:
     A Tensor which was upsampled using the specified method.
 
   Raises:
-    ValueError: if `method` is not recognized.
+    ValueError: if `method` is not recognized, if `fused_pad_conv` is used
+      with the 'NCHW' `data_format`, or if the strides of the 'subpixel' method
+      differ.
   """
+  if fused_pad_conv and data_format != 'NHWC':
+    raise ValueError('`fused_pad_conv` only supports the NHWC data format.')
   with tf.variable_scope('upconv'):
     net_shape = tf.shape(input=net)
-    height = net_shape[1]
-    width = net_shape[2]
+    if data_format == 'NCHW':
+      height = net_shape[2]
+      width = net_shape[3]
+    else:
+      height = net_shape[1]
+      width = net_shape[2]
 
-    # Reflection pad by 1 in spatial dimensions (axes 1, 2 = h, w) to make a 3x3
+    # Reflection pad by 1 in spatial dimensions (h, w) to make a 3x3
     # 'valid' convolution produce an output with the same dimension as the
     # input.
-    spatial_pad_1 = np.array([[0, 0], [1, 1], [1, 1], [0, 0]])
+    spatial_pad_1 = _same_paddings(3, 3, data_format)
 
     if method == 'nn_upsample_conv':
-      net = tf.image.resize(
-          net, [strides[0] * height, strides[1] * width],
-          method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-      net = tf.pad(tensor=net, paddings=spatial_pad_1, mode=pad_mode)
-      net = _conv2d(net, num_outputs, 3)
-      net = _instance_norm(net)
-      net = tf.nn.relu(net)
+      if isinstance(strides, (list, tuple)) and all(
+          isinstance(stride, (int, np.integer)) for stride in strides):
+        net = _nn_upsample(net, strides, data_format)
+      else:
+        net = _resize(
+            net, [strides[0] * height, strides[1] * width],
+            tf.image.ResizeMethod.NEAREST_NEIGHBOR, data_format)
+      net = _conv2d(net, num_outputs, 3, pad_mode=pad_mode,
+                    pad_sizes=spatial_pad_1, fused=fused_pad_conv,
+                    data_format=data_format)
+      net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                           data_format=data_format)
     elif method == 'bilinear_upsample_conv':
-      net = tf.image.resize(
-          net, [strides[0] * height, strides[1] * width],
-          method=tf.image.ResizeMethod.BILINEAR)
-      net = tf.pad(tensor=net, paddings=spatial_pad_1, mode=pad_mode)
-      net = _conv2d(net, num_outputs, 3)
-      net = _instance_norm(net)
-      net = tf.nn.relu(net)
+      new_size = [strides[0] * height, strides[1] * width]
+      if fused_pad_conv and pad_mode.upper() in ('REFLECT', 'SYMMETRIC'):
+        net = _fused_resize_and_pad_conv2d(
+            net, new_size, num_outputs, 3, pad_mode, spatial_pad_1)
+      else:
+        net = _resize(
+            net, new_size, tf.image.ResizeMethod.BILINEAR, data_format)
+        net = _conv2d(net, num_outputs, 3, pad_mode=pad_mode,
+                      pad_sizes=spatial_pad_1, data_format=data_format)
+      net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                           data_format=data_format)
+    elif method == 'subpixel':
+      if strides[0] != strides[1]:
+        raise ValueError('The subpixel method requires equal strides.')
+      net = _conv2d(net, num_outputs * strides[0] * strides[1], 3,
+                    pad_mode=pad_mode, pad_sizes=spatial_pad_1,
+                    fused=fused_pad_conv, data_format=data_format)
+      net = tf.nn.depth_to_space(
+          input=net, block_size=strides[0], data_format=data_format)
+      net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                           data_format=data_format)
     elif method == 'conv2d_transpose':
-      # This corrects 1 pixel offset for images with even width and height.
-      # conv2d is left aligned and conv2d_transpose is right aligned for even
-      # sized images (while doing 'SAME' padding).
-      # Note: This doesn't reflect actual model in paper.
-      net = tf.layers.conv2d_transpose(
-          net,
-          num_outputs,
-          kernel_size=[3, 3],
-          strides=strides,
-          padding='valid')
+      net = _cropped_conv2d_transpose(net, num_outputs, strides, data_format)
       net = tf.nn.relu(net)
-      net = net[:, 1:, 1:, :]
     else:
       raise ValueError('Unknown method: [%s]' % method)
 
     return net
 
 
-def _dynamic_or_static_shape(tensor):
-  static_shape = tensor.shape
-  shape = tf.shape(input=tensor)
-  return static_shape.as_list() if static_shape.is_fully_defined() else shape
+def _cropped_conv2d_transpose(net, num_outputs, strides, data_format='NHWC'):
+  """A 3x3 'valid' transposed convolution without its first row and column.
+
+  This corrects 1 pixel offset for images with even width and height.
+  conv2d is left aligned and conv2d_transpose is right aligned for even
+  sized images (while doing 'SAME' padding).
+  Note: This doesn't reflect actual model in paper.
+
+  The result is the same as `tf.layers.conv2d_transpose(..., padding='valid')`
+  followed by slicing off the first row and column, and uses the same
+  variables. For NHWC, the explicit padding of the transposed convolution does
+  the cropping so the larger output is never materialized. The CPU kernel
+  doesn't support explicit padding with NCHW, so NCHW still slices.
+
+  Args:
+    net: A Tensor of size [batch_size, height, width, filters], or of size
+      [batch_size, filters, height, width] if `data_format` is 'NCHW'.
+    num_outputs: The number of output filters.
+    strides: A list of 2 scalars, the strides of the transposed convolution.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
+
+  Returns:
+    The upsampled Tensor, of spatial size `(height - 1) * strides[0] + 2` by
+    `(width - 1) * strides[1] + 2`.
+  """
+  channels_axis = 1 if data_format == 'NCHW' else 3
+  in_channels = net.shape.as_list()[channels_axis]
+  with tf.variable_scope(None, default_name='conv2d_transpose'):
+    kernel = tf.get_variable(
+        'kernel',
+        shape=[3, 3, num_outputs, in_channels],
+        dtype=net.dtype,
+        initializer=tf.glorot_uniform_initializer())
+    bias = tf.get_variable(
+        'bias',
+        shape=[num_outputs],
+        dtype=net.dtype,
+        initializer=tf.zeros_initializer())
+
+  net_shape = tf.shape(input=net)
+  if data_format == 'NCHW':
+    output_shape = tf.stack([
+        net_shape[0],
+        num_outputs,
+        (net_shape[2] - 1) * strides[0] + 3,
+        (net_shape[3] - 1) * strides[1] + 3,
+    ])
+    net = tf.nn.conv2d_transpose(
+        net,
+        kernel,
+        output_shape,
+        strides=[1, 1, strides[0], strides[1]],
+        padding='VALID',
+        data_format='NCHW')
+    net = net[:, :, 1:, 1:]
+  else:
+    output_shape = tf.stack([
+        net_shape[0],
+        (net_shape[1] - 1) * strides[0] + 2,
+        (net_shape[2] - 1) * strides[1] + 2,
+        num_outputs,
+    ])
+    net = tf.nn.conv2d_transpose(
+        net,
+        kernel,
+        output_shape,
+        strides=[1, strides[0], strides[1], 1],
+        padding=[[0, 0], [1, 0], [1, 0], [0, 0]])
+  return tf.nn.bias_add(net, bias, data_format=data_format)
+
+
+def _conv2d(net, num_filters, kernel_size, strides=1, pad_mode=None,
+            pad_sizes=None, fused=False, data_format='NHWC', use_bias=False):
+  """A 'VALID' convolution with optional explicit padding of its inputs.
+
+  Args:
+    net: A Tensor of size [batch_size, height, width, channels], or of size
+      [batch_size, channels, height, width] if `data_format` is 'NCHW'.
+    num_filters: The number of output filters.
+    kernel_size: Size w or list/tuple [h, w] of the filter kernel.
+    strides: The stride of the convolution.
+    pad_mode: If set, the mode used to pad `net` by `pad_sizes` before the
+      convolution, one of "CONSTANT", "REFLECT", or "SYMMETRIC".
+    pad_sizes: A [4, 2] array of paddings applied to `net`, or None.
+    fused: If True and `pad_mode` is "REFLECT" or "SYMMETRIC", the padding is
+      folded into the convolution with `FusedPadConv2D`, so the padded tensor is
+      never materialized. The fused op only has a CPU kernel and no gradient,
+      and only supports the 'NHWC' `data_format`.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
+    use_bias: Whether to add a bias after the convolution. Most convolutions
+      are followed by instance norm, which makes a bias redundant.
+
+  Returns:
+    The convolved Tensor.
+  """
+  if pad_mode is not None and pad_sizes is not None:
+    if fused and pad_mode.upper() in ('REFLECT', 'SYMMETRIC'):
+      return _fused_pad_conv2d(net, num_filters, kernel_size, strides,
+                               pad_mode, pad_sizes, use_bias)
+    net = tf.pad(tensor=net, paddings=pad_sizes, mode=pad_mode)
+  kernel, bias = _conv2d_variables(
+      net, num_filters, kernel_size, use_bias, data_format)
+  if data_format == 'NCHW':
+    conv_strides = [1, 1, strides, strides]
+  else:
+    conv_strides = [1, strides, strides, 1]
+  net = tf.nn.conv2d(
+      net, kernel, conv_strides, padding='VALID', data_format=data_format)
+  if bias is not None:
+    net = tf.nn.bias_add(net, bias, data_format=data_format)
+  return net
+
+
+def _conv2d_variables(net, num_filters, kernel_size, use_bias=False,
+                      data_format='NHWC'):
+  """Creates the kernel and optional bias of a convolution applied to `net`."""
+  if not isinstance(kernel_size, (list, tuple)):
+    kernel_size = [kernel_size, kernel_size]
+  in_channels = net.shape.as_list()[1 if data_format == 'NCHW' else -1]
+  # Use the same variable names as `tf.layers.conv2d`, so that checkpoints of
+  # earlier versions of this network still load.
+  with tf.variable_scope(None, default_name='conv2d'):
+    kernel = tf.get_variable(
+        'kernel',
+        shape=list(kernel_size) + [in_channels, num_filters],
+        dtype=net.dtype,
+        initializer=_KERNEL_INITIALIZER)
+    bias = None
+    if use_bias:
+      bias = tf.get_variable(
+          'bias',
+          shape=[num_filters],
+          dtype=net.dtype,
+          initializer=tf.zeros_initializer())
+  return kernel, bias
+
+
+def _fused_pad_conv2d(net, num_filters, kernel_size, strides, pad_mode,
+                      pad_sizes, use_bias=False):
+  """Same as `_conv2d` with padding, but folds the padding into the conv."""
+  kernel, bias = _conv2d_variables(net, num_filters, kernel_size, use_bias)
+
+  def fused_op(x):
+    return tf.raw_ops.FusedPadConv2D(
+        input=x,
+        paddings=np.asarray(pad_sizes, dtype=np.int32),
+        filter=kernel,
+        mode=pad_mode.upper(),
+        strides=[1, strides, strides, 1],
+        padding='VALID')
+
+  net = _map_fused_op_over_batch(fused_op, net)
+  if bias is not None:
+    net = tf.nn.bias_add(net, bias)
+  return net
+
+
+def _fused_resize_and_pad_conv2d(net, new_size, num_filters, kernel_size,
+                                 pad_mode, pad_sizes):
+  """Bilinear resize, pad and conv folded into `FusedResizeAndPadConv2D`."""
+  kernel, _ = _conv2d_variables(net, num_filters, kernel_size)
+  new_size = tf.cast(tf.stack(new_size), tf.int32)
+
+  def fused_op(x):
+    return tf.raw_ops.FusedResizeAndPadConv2D(
+        input=x,
+        size=new_size,
+        paddings=np.asarray(pad_sizes, dtype=np.int32),
+        filter=kernel,
+        mode=pad_mode.upper(),
+        strides=[1, 1, 1, 1],
+        padding='VALID',
+        resize_align_corners=False)
+
+  return _map_fused_op_over_batch(fused_op, net)
+
+
+def _map_fused_op_over_batch(fused_op, net):
+  """Applies a fused conv op one example at a time.
+
+  The CPU kernels of `FusedPadConv2D` and `FusedResizeAndPadConv2D` only compute
+  the first example of a batch correctly, so larger batches are split up. The
+  `tf.map_fn` runs the examples sequentially and stacks their outputs through a
+  `TensorArray`, an extra copy that outweighs the saved padding copy.
+
+  Args:
+    fused_op: A function applying a fused conv op to a 4D Tensor.
+    net: A Tensor of size [batch_size, height, width, channels].
+
+  Returns:
+    The result of `fused_op` on all examples of `net`.
+  """
+  if net.shape.as_list()[0] == 1:
+    return fused_op(net)
+  return tf.map_fn(lambda x: fused_op(x[tf.newaxis])[0], net)
+
+
+def _resnet_block(net, num_filters, kernel_size, paddings, fused_pad_conv,
+                  data_format):
+  """A residual block of two padded convolutions with instance norm.
+
+  Args:
+    net: The input Tensor of the block.
+    num_filters: The number of filters of both convolutions, which must equal
+      the number of channels of `net`.
+    kernel_size: Size w or list/tuple [h, w] of the filter kernels.
+    paddings: The reflection paddings applied before each convolution.
+    fused_pad_conv: Whether to fold the paddings into `FusedPadConv2D` ops.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
+
+  Returns:
+    The output Tensor of the block, with the same shape as `net`.
+  """
+  res_net = _conv2d(net, num_filters, kernel_size, pad_mode='REFLECT',
+                    pad_sizes=paddings, fused=fused_pad_conv,
+                    data_format=data_format)
+  res_net = _instance_norm(res_net, activation_fn=tf.nn.relu,
+                           data_format=data_format)
+  res_net = _conv2d(res_net, num_filters, kernel_size, pad_mode='REFLECT',
+                    pad_sizes=paddings, fused=fused_pad_conv,
+                    data_format=data_format)
+  res_net = _instance_norm(res_net, data_format=data_format)
+  return tf.math.add(net, res_net)
+
+
+def _head_conv2d(net, num_filters, num_inner_filters, head_type,
+                 fused_pad_conv, data_format, use_bias=False):
+  """The reflection padded 7x7 input or output convolution of the generator.
+
+  Args:
+    net: The input Tensor of the convolution.
+    num_filters: The number of output filters.
+    num_inner_filters: The number of filters between the stacked convolutions
+      of the 'stacked_3x3' `head_type`.
+    head_type: Either '7x7' for a single 7x7 convolution, or 'stacked_3x3' for
+      three linear 3x3 convolutions with a 7x7 receptive field. These are a
+      low rank approximation of the 7x7 convolution, not an equivalent.
+    fused_pad_conv: Whether to fold the paddings into `FusedPadConv2D` ops.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
+    use_bias: Whether to add a bias after the (last) convolution.
+
+  Returns:
+    The convolved Tensor, with the same spatial size as `net`.
+  """
+  if head_type == '7x7':
+    return _conv2d(net, num_filters, 7, pad_mode='REFLECT',
+                   pad_sizes=_same_paddings(7, 7, data_format),
+                   fused=fused_pad_conv, data_format=data_format,
+                   use_bias=use_bias)
+  paddings = _same_paddings(3, 3, data_format)
+  for _ in xrange(2):
+    net = _conv2d(net, num_inner_filters, 3, pad_mode='REFLECT',
+                  pad_sizes=paddings, fused=fused_pad_conv,
+                  data_format=data_format)
+  return _conv2d(net, num_filters, 3, pad_mode='REFLECT', pad_sizes=paddings,
+                 fused=fused_pad_conv, data_format=data_format,
+                 use_bias=use_bias)
+
+
+def _resnet_tower(net, num_resnet_blocks, num_filters, kernel_size, paddings,
+                  fused_pad_conv, use_xla, data_format):
+  """A stack of residual blocks, optionally compiled as a single XLA cluster.
+
+  With `use_xla`, all blocks are compiled into one XLA cluster, so that each
+  skip connection add is fused with the normalization before it and the pad
+  after it instead of writing out the sum, and the whole tower runs as a
+  single launch.
 
+  Args:
+    net: The input Tensor of the tower.
+    num_resnet_blocks: Number of residual blocks.
+    num_filters: The number of filters of all convolutions, which must equal
+      the number of channels of `net`.
+    kernel_size: Size w or list/tuple [h, w] of the filter kernels.
+    paddings: The reflection paddings applied before each convolution.
+    fused_pad_conv: Whether to fold the paddings into `FusedPadConv2D` ops.
+    use_xla: Whether to compile the tower with XLA.
+    data_format: The data format of `net`, either 'NHWC' or 'NCHW'.
 
-def _conv2d(net, num_filters, kernel_size, strides=1):
-  return tf.layers.conv2d(
-      net,
-      num_filters,
-      kernel_size,
-      strides,
-      padding='VALID',
-      kernel_initializer=tf.random_normal_initializer(0, 0.02),
-      use_bias=False)
+  Returns:
+    The output Tensor of the tower, and a list of the outputs of each block.
+  """
+  block_outputs = []
+  with tf.variable_scope('residual_blocks'), _xla_scope(use_xla):
+    for block_id in xrange(num_resnet_blocks):
+      with tf.variable_scope('block_{}'.format(block_id)):
+        net = _resnet_block(net, num_filters, kernel_size, paddings,
+                            fused_pad_conv, data_format)
+        block_outputs.append(net)
+  return net, block_outputs
 
 
 def cyclegan_generator_resnet(images,
@@ -123,7 +544,13 @@ def cyclegan_generator_resnet(images,
                               num_filters=64,
                               upsample_fn=cyclegan_upsample,
                               kernel_size=3,
-                              tanh_linear_slope=0.0):
+                              tanh_linear_slope=0.0,
+                              fused_pad_conv=False,
+                              use_xla=False,
+                              data_format='NHWC',
+                              compute_dtype=tf.float32,
+                              use_output_bias=False,
+                              head_type='7x7'):
   """Defines the cyclegan resnet network architecture.
 
   As closely as possible following
@@ -144,6 +571,40 @@ def cyclegan_generator_resnet(images,
       layers.
     tanh_linear_slope: Slope of the linear function to add to the tanh over the
       logits.
+    fused_pad_conv: If True, fold the reflection padding of the encoder and
+      residual block convolutions into `FusedPadConv2D` ops instead of
+      materializing the padded tensors. The fused op only has a CPU kernel and
+      no gradient, so this is meant for inference. It is only correct for the
+      first example of a batch, so unless the static batch size is 1, it runs
+      one example at a time in a `tf.map_fn`, which adds a copy of the
+      outputs. The fused path can only pay off at batch size 1.
+      Pass `functools.partial(cyclegan_upsample, fused_pad_conv=True)` as
+      `upsample_fn` to fuse the decoder convolutions as well.
+    use_xla: If True, compile each encoder instance norm and ReLU pair, the
+      residual blocks including their skip connections, and the decoder
+      together with the output convolution into XLA clusters so the memory
+      bound ops are fused around the convolutions.
+    data_format: The data format used inside the network, either 'NHWC' or
+      'NCHW'. The input and output images are always NHWC, but with 'NCHW' they
+      are transposed once on entry and exit, and all other end points are NCHW.
+      Channels first convolutions are typically faster with cuDNN.
+      `upsample_fn` is then called with `data_format='NCHW'`.
+    compute_dtype: The dtype of the activations, e.g. `tf.float16` to halve the
+      memory traffic and use Tensor Cores. Variables are still stored in
+      float32 and instance norm statistics and the output tanh are computed in
+      float32. The fused pad conv ops don't support `tf.bfloat16`.
+    use_output_bias: If True, add a bias to the final convolution, the only one
+      that isn't followed by instance norm. Conv + BiasAdd can be fused by
+      Grappler. Graphs with and without the bias have different variables.
+    head_type: The input and output convolutions, either '7x7' for single 7x7
+      convolutions, or 'stacked_3x3' for three 3x3 convolutions each with the
+      same 7x7 receptive field. The stacked convolutions have no nonlinearity or
+      normalization in between, and only the image channels. That makes them
+      about 5 times cheaper (1890 instead of 9408 weights per head), but they
+      are a lower capacity, low rank approximation of the 7x7 convolutions, and
+      reflection padding each stage makes the borders differ as well. A
+      'stacked_3x3' generator has different variables and has to be trained
+      from scratch.
 
   Returns:
     A `Tensor` representing the model output and a dictionary of model end
@@ -151,7 +612,9 @@ def cyclegan_generator_resnet(images,
 
   Raises:
     ValueError: If the input height or width is known at graph construction time
-      and not a multiple of 4.
+      and not a multiple of 4, if `data_format` or `head_type` is not
+      recognized, or if `fused_pad_conv` is used with the 'NCHW'
+      `data_format`.
   """
   end_points = {}
 
@@ -162,78 +625,125 @@ def cyclegan_generator_resnet(images,
   if width and width % 4 != 0:
     raise ValueError('The input width must be a multiple of 4.')
   num_outputs = input_size[3]
+  if data_format not in ('NHWC', 'NCHW'):
+    raise ValueError('Unknown data format: [%s]' % data_format)
+  if fused_pad_conv and data_format != 'NHWC':
+    raise ValueError('`fused_pad_conv` only supports the NHWC data format.')
+  if head_type not in ('7x7', 'stacked_3x3'):
+    raise ValueError('Unknown head type: [%s]' % head_type)
 
   if not isinstance(kernel_size, (list, tuple)):
     kernel_size = [kernel_size, kernel_size]
 
-  kernel_height = kernel_size[0]
-  kernel_width = kernel_size[1]
-  pad_top = (kernel_height - 1) // 2
-  pad_bottom = kernel_height // 2
-  pad_left = (kernel_width - 1) // 2
-  pad_right = kernel_width // 2
-  paddings = np.array(
-      [[0, 0], [pad_top, pad_bottom], [pad_left, pad_right], [0, 0]],
-      dtype=np.int32)
-  spatial_pad_3 = np.array([[0, 0], [3, 3], [3, 3], [0, 0]])
+  paddings = _same_paddings(kernel_size[0], kernel_size[1], data_format)
+  upsample_kwargs = {} if data_format == 'NHWC' else {'data_format': 'NCHW'}
+
+  custom_getter = None
+  if compute_dtype != tf.float32:
+    custom_getter = _float32_variable_getter
+
+  net = tf.cast(images, compute_dtype)
+  if data_format == 'NCHW':
+    net = tf.transpose(a=net, perm=[0, 3, 1, 2])
+
+  # All scopes below, including the purely structural 'decoder', 'decoder1',
+  # 'decoder2' and 'output', contain the variables of their layers. They have to
+  # be variable scopes, since `tf.name_scope` doesn't affect variable names:
+  # checkpoints would no longer load and both 'upconv' scopes would collide.
 
   ###########
   # Encoder #
   ###########
-  with tf.variable_scope('input'):
+  with tf.variable_scope('input', custom_getter=custom_getter):
     # 7x7 input stage
-    net = tf.pad(tensor=images, paddings=spatial_pad_3, mode='REFLECT')
-    net = _conv2d(net, num_filters, kernel_size=7)
-    net = _instance_norm(net)
-    net = tf.nn.relu(net)
+    net = _head_conv2d(net, num_filters, num_outputs, head_type,
+                       fused_pad_conv, data_format)
+    net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                         data_format=data_format)
     end_points['encoder_0'] = net
 
-  with tf.variable_scope('encoder'):
-    net = tf.pad(tensor=net, paddings=paddings, mode='REFLECT')
-    net = _conv2d(net, num_filters * 2, kernel_size, strides=2)
-    net = _instance_norm(net)
-    net = tf.nn.relu(net)
+  with tf.variable_scope('encoder', custom_getter=custom_getter):
+    net = _conv2d(net, num_filters * 2, kernel_size, strides=2,
+                  pad_mode='REFLECT', pad_sizes=paddings, fused=fused_pad_conv,
+                  data_format=data_format)
+    net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                         data_format=data_format)
     end_points['encoder_1'] = net
-    net = tf.pad(tensor=net, paddings=paddings, mode='REFLECT')
-    net = _conv2d(net, num_filters * 4, kernel_size, strides=2)
-    net = _instance_norm(net)
-    net = tf.nn.relu(net)
+    net = _conv2d(net, num_filters * 4, kernel_size, strides=2,
+                  pad_mode='REFLECT', pad_sizes=paddings, fused=fused_pad_conv,
+                  data_format=data_format)
+    net = _instance_norm(net, activation_fn=tf.nn.relu, use_xla=use_xla,
+                         data_format=data_format)
     end_points['encoder_2'] = net
 
     ###################
     # Residual Blocks #
     ###################
-    with tf.variable_scope('residual_blocks'):
-      for block_id in xrange(num_resnet_blocks):
-        with tf.variable_scope('block_{}'.format(block_id)):
-          res_net = tf.pad(tensor=net, paddings=paddings, mode='REFLECT')
-          res_net = _conv2d(res_net, num_filters * 4, kernel_size)
-          res_net = _instance_norm(res_net)
-          res_net = tf.nn.relu(res_net)
-          res_net = tf.pad(tensor=res_net, paddings=paddings, mode='REFLECT')
-          res_net = _conv2d(res_net, num_filters * 4, kernel_size)
-          res_net = _instance_norm(res_net)
-          net += res_net
-          end_points['resnet_block_%d' % block_id] = net
+    net, block_outputs = _resnet_tower(
+        net, num_resnet_blocks, num_filters * 4, kernel_size, paddings,
+        fused_pad_conv, use_xla, data_format)
+    for block_id, block_output in enumerate(block_outputs):
+      end_points['resnet_block_%d' % block_id] = block_output
 
     ###########
     # Decoder #
     ###########
-    with tf.variable_scope('decoder'):
-      with tf.variable_scope('decoder1'):
-        net = upsample_fn(net, num_outputs=num_filters * 2, strides=[2, 2])
-      end_points['decoder1'] = net
+    # The decoder and the output convolution form one XLA cluster, so that the
+    # instance norm reductions are scheduled together with the convolutions
+    # producing and consuming them.
+    with _xla_scope(use_xla):
+      with tf.variable_scope('decoder'):
+        with tf.variable_scope('decoder1'):
+          net = upsample_fn(net, num_outputs=num_filters * 2, strides=[2, 2],
+                            **upsample_kwargs)
+        end_points['decoder1'] = net
+
+        with tf.variable_scope('decoder2'):
+          net = upsample_fn(net, num_outputs=num_filters, strides=[2, 2],
+                            **upsample_kwargs)
+        end_points['decoder2'] = net
+
+      with tf.variable_scope('output'):
+        logits = _head_conv2d(net, num_outputs, num_outputs, head_type,
+                              fused_pad_conv, data_format, use_output_bias)
+        if data_format == 'NCHW':
+          logits = tf.transpose(a=logits, perm=[0, 2, 3, 1])
+        logits = tf.cast(logits, tf.float32)
+        # The convolutions already produce the input shape, so only annotate it.
+        logits = tf.ensure_shape(logits, images.shape)
+
+        end_points['logits'] = logits
+        if tanh_linear_slope:
+          end_points['predictions'] = (
+              tf.tanh(logits) + logits * tanh_linear_slope)
+        else:
+          end_points['predictions'] = tf.tanh(logits)
 
-      with tf.variable_scope('decoder2'):
-        net = upsample_fn(net, num_outputs=num_filters, strides=[2, 2])
-      end_points['decoder2'] = net
+  return end_points['predictions'], end_points
 
-    with tf.variable_scope('output'):
-      net = tf.pad(tensor=net, paddings=spatial_pad_3, mode='REFLECT')
-      logits = _conv2d(net, num_outputs, 7)
-      logits = tf.reshape(logits, _dynamic_or_static_shape(images))
 
-      end_points['logits'] = logits
-      end_points['predictions'] = tf.tanh(logits) + logits * tanh_linear_slope
+def cyclegan_generator_resnet_xla(images, **kwargs):
+  """`cyclegan_generator_resnet` compiled into a single XLA cluster.
 
-  return end_points['predictions'], end_points
+  Instead of compiling the normalizations and residual blocks separately as
+  with `use_xla`, the whole generator is compiled at once, so XLA can also
+  optimize the layout and fuse ops across the encoder, residual blocks and
+  decoder. XLA compiles the cluster once per distinct input shape and reuses the
+  compiled executable for all later steps with that shape. Has no effect in
+  eager mode.
+
+  Args:
+    images: Input image tensor of shape [batch_size, h, w, 3].
+    **kwargs: Other arguments of `cyclegan_generator_resnet`. `use_xla`, of
+      the generator or of `upsample_fn`, makes no difference, since nested XLA
+      scopes are part of the enclosing cluster.
+
+  Returns:
+    A `Tensor` representing the model output and a dictionary of model end
+      points.
+
+  Raises:
+    ValueError: For the same reasons as `cyclegan_generator_resnet`.
+  """
+  with _xla_scope(True):
+    return cyclegan_generator_resnet(images, **kwargs)
@@ -19,7 +19,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+
 from absl.testing import parameterized
+import numpy as np
 import tensorflow.compat.v1 as tf
 
 from tensorflow_gan.examples.cyclegan import generator
@@ -36,6 +39,51 @@ class CycleganTest(tf.test.TestCase, parameterized.TestCase):
       sess.run(tf.global_variables_initializer())
       sess.run(model_output)
 
+  @parameterized.parameters(
+      {'method': 'nn_upsample_conv'},
+      {'method': 'bilinear_upsample_conv'},
+      {'method': 'subpixel'},
+      {'method': 'conv2d_transpose'},
+  )
+  def test_upsample_shape(self, method):
+    """Check that each upsample method doubles the spatial dimensions."""
+    net = tf.zeros([2, 8, 12, 16])
+    upsampled = generator.cyclegan_upsample(
+        net, num_outputs=4, strides=[2, 2], method=method)
+    self.assertAllEqual([2, 16, 24, 4], upsampled.shape.as_list())
+
+  @parameterized.parameters(
+      {'strides': [2, 2]},
+      {'strides': [3, 2]},
+  )
+  def test_nn_upsample_matches_resize(self, strides):
+    """Check that upsampling by repeating matches the nearest resize."""
+    net = tf.constant(np.random.randn(2, 5, 7, 3), dtype=tf.float32)
+    resized = tf.image.resize(
+        net, [5 * strides[0], 7 * strides[1]],
+        method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    upsampled = generator._nn_upsample(net, strides)
+    with self.cached_session() as sess:
+      resized_np, upsampled_np = sess.run([resized, upsampled])
+    self.assertAllEqual(resized_np, upsampled_np)
+
+  def test_nn_upsample_conv_tensor_strides(self):
+    """Check that strides given as a Tensor fall back to the resize."""
+    with tf.Graph().as_default():
+      upsampled = generator.cyclegan_upsample(
+          tf.zeros([2, 8, 8, 4]), num_outputs=4, strides=tf.constant([2, 2]),
+          method='nn_upsample_conv')
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        upsampled_np = sess.run(upsampled)
+    self.assertAllEqual([2, 16, 16, 4], upsampled_np.shape)
+
+  def test_upsample_subpixel_unequal_strides(self):
+    with self.assertRaisesRegexp(ValueError, 'requires equal strides'):
+      generator.cyclegan_upsample(
+          tf.zeros([2, 8, 8, 16]), num_outputs=4, strides=[2, 3],
+          method='subpixel')
+
   @parameterized.parameters(
       {'shape': [4, 32, 32, 3]},  # small
       {'shape': [3, 128, 128, 3]},  # medium
@@ -46,6 +94,219 @@ class CycleganTest(tf.test.TestCase, parameterized.TestCase):
     output_imgs, _ = generator.cyclegan_generator_resnet(tf.ones(shape))
     self.assertAllEqual(shape, output_imgs.shape.as_list())
 
+  @parameterized.parameters(
+      {'method': 'nn_upsample_conv'},
+      {'method': 'bilinear_upsample_conv'},
+      {'method': 'subpixel'},
+      {'method': 'conv2d_transpose'},
+  )
+  def test_generator_fused_pad_conv(self, method):
+    """Check that the fused pad + conv graph runs and keeps the shape."""
+    img_batch = tf.zeros([2, 32, 32, 3])
+    upsample_fn = functools.partial(
+        generator.cyclegan_upsample, method=method, fused_pad_conv=True)
+    model_output, _ = generator.cyclegan_generator_resnet(
+        img_batch, upsample_fn=upsample_fn, fused_pad_conv=True)
+    self.assertAllEqual([2, 32, 32, 3], model_output.shape.as_list())
+    with self.cached_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(model_output)
+
+  @parameterized.parameters(
+      {'method': 'nn_upsample_conv'},
+      {'method': 'bilinear_upsample_conv'},
+      {'method': 'conv2d_transpose'},
+  )
+  def test_generator_nchw(self, method):
+    """Check that the channels first generator keeps NHWC inputs/outputs."""
+    img_batch = tf.zeros([2, 32, 48, 3])
+    upsample_fn = functools.partial(generator.cyclegan_upsample, method=method)
+    model_output, end_points = generator.cyclegan_generator_resnet(
+        img_batch, upsample_fn=upsample_fn, data_format='NCHW')
+    self.assertAllEqual([2, 32, 48, 3], model_output.shape.as_list())
+    self.assertAllEqual([2, 64, 32, 48],
+                        end_points['decoder2'].shape.as_list())
+    with self.cached_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(model_output)
+
+  @parameterized.parameters(
+      {'compute_dtype': tf.float16, 'data_format': 'NHWC'},
+      {'compute_dtype': tf.bfloat16, 'data_format': 'NHWC'},
+      {'compute_dtype': tf.float16, 'data_format': 'NCHW'},
+  )
+  def test_generator_reduced_precision(self, compute_dtype, data_format):
+    """Check reduced precision activations with float32 vars and outputs."""
+    with tf.Graph().as_default():
+      img_batch = tf.zeros([2, 32, 32, 3])
+      model_output, end_points = generator.cyclegan_generator_resnet(
+          img_batch, compute_dtype=compute_dtype, data_format=data_format)
+      self.assertEqual(tf.float32, model_output.dtype)
+      self.assertEqual(compute_dtype, end_points['encoder_2'].dtype)
+      for variable in tf.global_variables():
+        self.assertEqual(tf.float32, variable.dtype.base_dtype)
+      if data_format == 'NCHW' and not tf.test.is_gpu_available():
+        # The CPU has no half precision channels first transposed conv kernel.
+        return
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(model_output)
+
+  def test_generator_xla(self):
+    """Check that the generator runs with XLA compiled normalizations."""
+    with tf.Graph().as_default():
+      img_batch = tf.zeros([2, 32, 32, 3])
+      model_output, _ = generator.cyclegan_generator_resnet(
+          img_batch, use_xla=True)
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        output_np = sess.run(model_output)
+    self.assertAllEqual([2, 32, 32, 3], output_np.shape)
+
+  @parameterized.parameters(
+      {'upsample_use_xla': False},
+      {'upsample_use_xla': True},
+  )
+  def test_generator_xla_decoder_single_cluster(self, upsample_use_xla):
+    """Check that the decoder and output are compiled into one XLA scope."""
+    with tf.Graph().as_default():
+      img_batch = tf.zeros([2, 32, 32, 3])
+      upsample_fn = functools.partial(
+          generator.cyclegan_upsample, use_xla=upsample_use_xla)
+      generator.cyclegan_generator_resnet(
+          img_batch, upsample_fn=upsample_fn, use_xla=True)
+      xla_scopes = set()
+      for op in tf.get_default_graph().get_operations():
+        if op.name.startswith(('encoder/decoder/', 'encoder/output/')):
+          xla_scopes.add(op.get_attr('_XlaScope'))
+      self.assertLen(xla_scopes, 1)
+
+  def test_generator_xla_single_cluster(self):
+    """Check that the whole generator is compiled into one XLA scope."""
+    with tf.Graph().as_default():
+      img_batch = tf.zeros([2, 32, 32, 3])
+      model_output, _ = generator.cyclegan_generator_resnet_xla(img_batch)
+      xla_scopes = set()
+      for op in tf.get_default_graph().get_operations():
+        if '_XlaScope' in op.node_def.attr:
+          xla_scopes.add(op.get_attr('_XlaScope'))
+      self.assertLen(xla_scopes, 1)
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        output_np = sess.run(model_output)
+    self.assertAllEqual([2, 32, 32, 3], output_np.shape)
+
+  def test_generator_xla_nested_single_cluster(self):
+    """Check that `use_xla` inside the whole generator scope adds no scope."""
+    with tf.Graph().as_default():
+      img_batch = tf.zeros([2, 32, 32, 3])
+      upsample_fn = functools.partial(
+          generator.cyclegan_upsample, use_xla=True)
+      generator.cyclegan_generator_resnet_xla(
+          img_batch, upsample_fn=upsample_fn, use_xla=True)
+      xla_scopes = set()
+      for op in tf.get_default_graph().get_operations():
+        if '_XlaScope' in op.node_def.attr:
+          xla_scopes.add(op.get_attr('_XlaScope'))
+      self.assertLen(xla_scopes, 1)
+
+  def test_fused_pad_conv_matches_unfused(self):
+    """Check that folding the padding into the conv doesn't change results."""
+    with tf.Graph().as_default():
+      images = tf.constant(np.random.randn(3, 8, 8, 4), dtype=tf.float32)
+      paddings = [[0, 0], [1, 1], [1, 1], [0, 0]]
+      with tf.variable_scope('unfused'):
+        unfused = generator._conv2d(
+            images, 5, 3, strides=2, pad_mode='REFLECT', pad_sizes=paddings)
+      with tf.variable_scope('fused'):
+        fused = generator._conv2d(
+            images, 5, 3, strides=2, pad_mode='REFLECT', pad_sizes=paddings,
+            fused=True)
+      unfused_kernel, fused_kernel = tf.global_variables()
+      copy_kernel = tf.assign(fused_kernel, unfused_kernel)
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(copy_kernel)
+        unfused_np, fused_np = sess.run([unfused, fused])
+    self.assertAllClose(unfused_np, fused_np)
+
+  @parameterized.parameters(
+      {'data_format': 'NHWC'},
+      {'data_format': 'NCHW'},
+  )
+  def test_cropped_conv2d_transpose_matches_sliced(self, data_format):
+    """Check that the cropped output matches slicing the valid output."""
+    with tf.Graph().as_default():
+      net = tf.constant(np.random.randn(2, 8, 6, 4), dtype=tf.float32)
+      with tf.variable_scope('sliced'):
+        sliced = tf.layers.conv2d_transpose(
+            net, 5, kernel_size=[3, 3], strides=[2, 2], padding='valid')
+        sliced = sliced[:, 1:, 1:, :]
+      with tf.variable_scope('cropped'):
+        if data_format == 'NCHW':
+          cropped = generator._cropped_conv2d_transpose(
+              tf.transpose(a=net, perm=[0, 3, 1, 2]), 5, [2, 2], 'NCHW')
+          cropped = tf.transpose(a=cropped, perm=[0, 2, 3, 1])
+        else:
+          cropped = generator._cropped_conv2d_transpose(net, 5, [2, 2])
+      copy_vars = [
+          tf.assign(cropped_var, sliced_var) for sliced_var, cropped_var in
+          zip(tf.global_variables('sliced'), tf.global_variables('cropped'))]
+      self.assertAllEqual([2, 16, 12, 5], cropped.shape.as_list())
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(copy_vars)
+        sliced_np, cropped_np = sess.run([sliced, cropped])
+    self.assertAllClose(sliced_np, cropped_np)
+
+  @parameterized.parameters(
+      {'tanh_linear_slope': 0.0},
+      {'tanh_linear_slope': 0.1},
+  )
+  def test_generator_tanh_linear_slope(self, tanh_linear_slope):
+    """Check the output activation with and without a linear slope."""
+    img_batch = tf.ones([2, 32, 32, 3])
+    model_output, end_points = generator.cyclegan_generator_resnet(
+        img_batch, tanh_linear_slope=tanh_linear_slope)
+    logits = end_points['logits']
+    with self.cached_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      output_np, logits_np = sess.run([model_output, logits])
+    self.assertAllClose(np.tanh(logits_np) + logits_np * tanh_linear_slope,
+                        output_np)
+
+  @parameterized.parameters(
+      {'fused_pad_conv': False},
+      {'fused_pad_conv': True},
+  )
+  def test_generator_output_bias(self, fused_pad_conv):
+    """Check that only the output convolution gets a bias."""
+    with tf.Graph().as_default():
+      generator.cyclegan_generator_resnet(
+          tf.zeros([1, 32, 32, 3]), fused_pad_conv=fused_pad_conv,
+          use_output_bias=True)
+      bias_names = [var.op.name for var in tf.global_variables()
+                    if var.op.name.endswith('/conv2d/bias')]
+    self.assertEqual(['encoder/output/conv2d/bias'], bias_names)
+
+  def test_generator_stacked_3x3_head(self):
+    """Check that the stacked 3x3 heads keep the shape and use 3x3 kernels."""
+    with tf.Graph().as_default():
+      output_imgs, _ = generator.cyclegan_generator_resnet(
+          tf.ones([2, 32, 32, 3]), head_type='stacked_3x3')
+      self.assertAllEqual([2, 32, 32, 3], output_imgs.shape.as_list())
+      head_kernels = [var for var in tf.global_variables()
+                      if var.op.name.startswith(('input/', 'encoder/output/'))
+                      and var.op.name.endswith('/kernel')]
+    self.assertLen(head_kernels, 6)
+    for kernel in head_kernels:
+      self.assertAllEqual([3, 3], kernel.shape.as_list()[:2])
+
+  def test_generator_unknown_head_type(self):
+    with self.assertRaisesRegexp(ValueError, 'Unknown head type'):
+      generator.cyclegan_generator_resnet(
+          tf.ones([2, 32, 32, 3]), head_type='5x5')
+
   def test_generator_unknown_batch_dim(self):
     """Check that generator can take unknown batch dimension inputs."""
     if tf.executing_eagerly():
@@ -55,6 +55,11 @@ flags.DEFINE_string(
 flags.DEFINE_integer('patch_dim', 128,
                      'The patch size of images that was used in train.py.')
 
+flags.DEFINE_string(
+    'frozen_graph_path', '',
+    'Optional: Where to write the inference GraphDef with the restored '
+    'variables folded into constants.')
+
 FLAGS = flags.FLAGS
 
 
@@ -114,6 +119,27 @@ def export(sess, input_pl, output_tensor, input_file_pattern, output_dir):
       PIL.Image.fromarray(image_np).save(output_path)
 
 
+def freeze(sess, output_tensors, output_path):
+  """Writes the inference graph with its variables converted to constants.
+
+  Constant weights let the graph optimizer fold and fuse the convolutions, and
+  drop the variable initializers from the exported graph.
+
+  Args:
+    sess: tf.Session with variables already loaded.
+    output_tensors: List of the generated output tensors to keep.
+    output_path: Path of the binary GraphDef to write.
+  """
+  graph_def = tf.graph_util.convert_variables_to_constants(
+      sess, sess.graph.as_graph_def(),
+      [tensor.op.name for tensor in output_tensors])
+  tf.io.write_graph(
+      graph_def,
+      os.path.dirname(output_path),
+      os.path.basename(output_path),
+      as_text=False)
+
+
 def _validate_flags():
   flags.register_validator('checkpoint_path', bool,
                            'Must provide `checkpoint_path`.')
@@ -143,6 +169,8 @@ def main(_):
            FLAGS.generated_y_dir)
     export(sess, images_y_hwc_pl, generated_x, FLAGS.image_set_y_glob,
            FLAGS.generated_x_dir)
+    if FLAGS.frozen_graph_path:
+      freeze(sess, [generated_y, generated_x], FLAGS.frozen_graph_path)
 
 
 if __name__ == '__main__':
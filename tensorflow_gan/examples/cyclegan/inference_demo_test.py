@@ -52,6 +52,7 @@ class InferenceDemoTest(tf.test.TestCase):
         '*.jpg')
     self._genx_dir = os.path.join(FLAGS.test_tmpdir, 'genx')
     self._geny_dir = os.path.join(FLAGS.test_tmpdir, 'geny')
+    self._frozen_graph_path = os.path.join(FLAGS.test_tmpdir, 'frozen.pb')
 
   @mock.patch.object(tfgan, 'gan_train', autospec=True)
   @mock.patch.object(
@@ -96,6 +97,7 @@ class InferenceDemoTest(tf.test.TestCase):
     FLAGS.image_set_y_glob = self._image_glob
     FLAGS.generated_x_dir = self._genx_dir
     FLAGS.generated_y_dir = self._geny_dir
+    FLAGS.frozen_graph_path = self._frozen_graph_path
 
     inference_demo.main(None)
     logging.info('gen x: %s', os.listdir(self._genx_dir))
@@ -114,6 +116,13 @@ class InferenceDemoTest(tf.test.TestCase):
         image_path = os.path.join(directory, base_name)
         self.assertRealisticImage(image_path)
 
+    # Check that the frozen graph has no variables left.
+    graph_def = tf.GraphDef()
+    with tf.io.gfile.GFile(self._frozen_graph_path, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+    for node in graph_def.node:
+      self.assertNotIn(node.op, ('VariableV2', 'VarHandleOp'))
+
   def assertRealisticImage(self, image_path):
     logging.info('Testing %s for realism.', image_path)
     # If the normalization is off or forgotten, then the generated image is